@@ -1,17 +1,11 @@
 import os
+import math
 import warnings
 import numpy as np
+from numba import njit, prange, vectorize, float32, float64
 
 import torch
-from torch.utils.data import Dataset, DataLoader
-
-import matplotlib as mpl
-from matplotlib import pyplot as plt
-from matplotlib.collections import LineCollection
-import matplotlib.patches as patches
-
-from sklearn.cluster import MeanShift
-from sklearn.neighbors.kde import KernelDensity
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler
 
 
 latex_fonts = {
@@ -22,7 +16,98 @@ latex_fonts = {
     "font.size": 16,
     "legend.fontsize": 10,
 }
-mpl.rcParams.update(latex_fonts)
+_style_applied = False
+
+
+# Plotting libraries are imported on first use, so that training runs
+# importing this module don't pay for matplotlib
+def _setup_style():
+    global _style_applied
+    if not _style_applied:
+        import matplotlib as mpl
+        mpl.rcParams.update(latex_fonts)
+        _style_applied = True
+
+
+
+# Initial velocity components from speed and launch angle, as compiled
+# ufuncs usable both from numpy and inside the kernels below
+@vectorize([float32(float32, float32), float64(float64, float64)], cache=True)
+def _vx(v0, angle):
+    return v0 * math.cos(angle)
+
+@vectorize([float32(float32, float32), float64(float64, float64)], cache=True)
+def _vy(v0, angle):
+    return v0 * math.sin(angle)
+
+
+# Fill the (N,T) trajectory arrays xt, yt in place, parallel over samples
+# and without any intermediate (N,T) temporaries
+@njit(parallel=True, fastmath=True, cache=True)
+def _traj_kernel(x0, y0, angle, v0, k, m, g, t, expterm, xt, yt):
+    for i in prange(xt.shape[0]):
+        vx = _vx(v0[i], angle[i])
+        vy = _vy(v0[i], angle[i])
+        cx = vx*m / k
+        cy = m / (k*k)
+        gm_vyk = g*m + vy*k
+        for j in range(xt.shape[1]):
+            xt[i,j] = x0[i] - cx * expterm[j]
+            yt[i,j] = y0[i] - cy * (gm_vyk * expterm[j] + g*t[j]*k)
+
+
+# Horizontal impact position per sample, found by Newton's method on the
+# closed-form height; NaN where the apex is below ground (e.g. y0 < 0),
+# so the trajectory never comes down onto it
+@njit(parallel=True, cache=True)
+def _impact_kernel(x0, y0, angle, v0, k, m, g, x_impact):
+    for i in prange(x_impact.shape[0]):
+        vx = _vx(v0[i], angle[i])
+        vy = _vy(v0[i], angle[i])
+        cy = m / (k*k)
+        gm_vyk = g*m + vy*k
+        # Apex of the height, at t=0 when launched downwards
+        t = 0.0
+        if gm_vyk > g*m:
+            t = (m/k) * math.log(gm_vyk / (g*m))
+        if y0[i] - cy * (gm_vyk * (math.exp(-k*t / m) - 1) + g*t*k) < 0:
+            x_impact[i] = np.nan
+            continue
+        # Height eventually falls linearly, so doubling t finds a time below
+        # ground; being concave, iterating from there moves monotonically
+        # towards the root on the descending branch
+        t = max(t, 1.0)
+        while y0[i] - cy * (gm_vyk * (math.exp(-k*t / m) - 1) + g*t*k) >= 0:
+            t *= 2
+        landed = False
+        for _ in range(50):
+            e = math.exp(-k*t / m)
+            y = y0[i] - cy * (gm_vyk * (e - 1) + g*t*k)
+            dy = (gm_vyk * e - g*m) / k
+            if dy >= 0:
+                break
+            step = y / dy
+            t -= step
+            if abs(step) < 1e-7:
+                landed = True
+                break
+        if landed:
+            x_impact[i] = x0[i] - (vx*m / k) * (math.exp(-k*t / m) - 1)
+        else:
+            x_impact[i] = np.nan
+
+
+
+# Gaussian kernel density estimate of 1D samples on an evenly spaced domain,
+# computed by binning and convolving via FFT (zero-padded against wrap-around)
+def _fft_kde(samples, domain, bw):
+    n = len(domain)
+    dx = domain[1] - domain[0]
+    counts, _ = np.histogram(samples, bins=n, range=(domain[0]-dx/2, domain[-1]+dx/2))
+    freq = np.fft.rfftfreq(2*n, d=dx)
+    kernel = np.exp(-0.5 * (2*np.pi*freq*bw)**2)
+    density = np.fft.irfft(np.fft.rfft(counts, 2*n) * kernel, 2*n)[:n]
+    return density / (len(samples) * dx)
 
 
 
@@ -32,65 +117,98 @@ class InverseBallisticsModel():
     n_observations = 1
     name = 'inverse-ballistics'
 
-    def __init__(self, g=9.81, k=0.25, m=0.2):
+    def __init__(self, g=9.81, k=0.25, m=0.2, seed=None):
         self.name = 'inverse-ballistics'
 
-        self.g = g # gravity
-        self.k = k # drag coefficient dependent on object shape and traversed medium
-        self.m = m # object mass
+        # Single precision is plenty for plotting and impact extraction
+        self.g = np.float32(g) # gravity
+        self.k = np.float32(k) # drag coefficient dependent on object shape and traversed medium
+        self.m = np.float32(m) # object mass
 
         self.xy_mu = np.array((0, 1.5))
         self.xy_std = np.array((0.5, 0.5))
+        self.rng = np.random.default_rng(seed)
+
+        # Time grid and drag term only depend on k and m, so compute them once
+        self.t = np.linspace(0, 6, 1500, dtype=np.float32)
+        self.expterm = np.exp(-self.k*self.t / self.m) - 1
 
     def sample_prior(self, N):
-        x = np.random.randn(N, 1) * self.xy_std[0] + self.xy_mu[0]
-        y = np.random.randn(N, 1) * self.xy_std[1] + self.xy_mu[1]
-        y = np.maximum(y, 0)
-        angle = np.random.rand(N, 1) * np.pi/2 * 0.8 + np.pi/2 * 0.1
-        v0 = np.random.poisson(15, (N, 1))
-        return np.concatenate([x, y, angle, v0], axis=1)
+        # Fill one parameter per contiguous row, return as (N,4) view
+        out = np.empty((4, N), dtype=np.float32)
+        self.rng.standard_normal(N, dtype=np.float32, out=out[0])
+        out[0] *= self.xy_std[0]; out[0] += self.xy_mu[0]
+        self.rng.standard_normal(N, dtype=np.float32, out=out[1])
+        out[1] *= self.xy_std[1]; out[1] += self.xy_mu[1]
+        # Truncate the launch height at the ground by redrawing negatives
+        neg = np.flatnonzero(out[1] < 0)
+        while len(neg) > 0:
+            out[1,neg] = self.rng.standard_normal(len(neg), dtype=np.float32) * self.xy_std[1] + self.xy_mu[1]
+            neg = neg[out[1,neg] < 0]
+        self.rng.random(N, dtype=np.float32, out=out[2])
+        out[2] *= np.pi/2 * 0.8; out[2] += np.pi/2 * 0.1
+        out[3] = self.rng.poisson(15, N)
+        return out.T
 
     def trajectories_from_parameters(self, x):
-        x0, y0, angle, v0 = np.split(x, 4, axis=1)
-        v0 = np.repeat(v0, 1500, axis=-1)
-        angle = np.repeat(angle, 1500, axis=-1)
-        t = np.repeat(np.linspace(0, 6, 1500)[None,:], x.shape[0], axis=0)
-        vx = v0 * np.cos(angle)
-        vy = v0 * np.sin(angle)
-
-        expterm = np.exp(-self.k*t / self.m) - 1
-        xt = x0 - (vx*self.m / self.k) * expterm
-        yt = y0 - (self.m/(self.k*self.k)) * ((self.g*self.m + vy*self.k) * expterm + self.g*t*self.k)
+        x = np.asarray(x, dtype=np.float32)
+        xt = np.empty((x.shape[0], len(self.t)), dtype=np.float32)
+        yt = np.empty((x.shape[0], len(self.t)), dtype=np.float32)
+        _traj_kernel(x[:,0], x[:,1], x[:,2], x[:,3], self.k, self.m, self.g,
+                     self.t, self.expterm, xt, yt)
         return xt, yt
 
-    def impact_from_trajectories(self, xs, ys):
-        ys_peak = np.argmax(ys, axis=1)
-        ys_after_peak = np.where(xs < xs[np.arange(xs.shape[0]), ys_peak][:,None], 0.1, ys)
-        xs_impact = xs[np.diff(np.signbit(ys_after_peak)).nonzero()]
+    def impact_from_trajectories(self, xs, ys, return_rows=False):
+        import numexpr as ne
+        rows = np.arange(xs.shape[0])
+        xs_peak = xs[rows, np.argmax(ys, axis=1)][:,None]
+        # Ground crossings after the peak, in a single fused pass
+        # (points before the peak count as above ground)
+        xa, xb, ya, yb = xs[:,:-1], xs[:,1:], ys[:,:-1], ys[:,1:]
+        cross = ne.evaluate('((xa < xs_peak) | (ya >= 0)) & (xb >= xs_peak) & (yb < 0)')
+        idx = cross.argmax(axis=1)
+        has_impact = cross[rows, idx]
+        xs_impact = xs[rows[has_impact], idx[has_impact]]
+        if return_rows:
+            return xs_impact, rows[has_impact]
         return xs_impact
 
     def forward_process(self, x):
-        xs, ys = self.trajectories_from_parameters(x)
-        return self.impact_from_trajectories(xs, ys)[:,None]
+        # Returns the (N,1) impact positions, NaN for trajectories whose
+        # apex is below ground (only possible for parameters outside the prior)
+        x = np.asarray(x, dtype=np.float32)
+        x_impact = np.empty(x.shape[0], dtype=np.float32)
+        _impact_kernel(x[:,0], x[:,1], x[:,2], x[:,3], self.k, self.m, self.g, x_impact)
+        return x_impact[:,None]
+
+    def trajectory_lines(self, xs, ys, max_lines=1000, step=4):
+        # Many overlaid trajectories look the same with fewer time steps
+        if len(xs) > max_lines:
+            xs, ys = xs[:,::step], ys[:,::step]
+        return np.stack([xs, ys], axis=-1)
 
     def init_plot(self, y_target):
+        from matplotlib import pyplot as plt
+        _setup_style()
         return plt.figure(figsize=(8,8))
 
     def update_plot(self, x, y_target):
+        from matplotlib import pyplot as plt
+        from matplotlib.collections import LineCollection
+        _setup_style()
         plt.gcf().clear()
         x = np.array(x)
         xs, ys = self.trajectories_from_parameters(x)
 
-        # Trajectories
-        lines = np.stack([xs, ys], axis=-1)
-        lines = [np.squeeze(line) for line in np.split(lines, len(lines))]
+        # Trajectories, passed to LineCollection as one (N,T,2) array
+        lines = self.trajectory_lines(xs, ys)
         line_collection = LineCollection(lines, linewidths=1, alpha=0.1, rasterized=True)
         plt.gca().add_collection(line_collection)
 
         # Arrows for initial velocity
-        x0, y0, angle, v0 = [np.squeeze(p) for p in np.split(x, 4, axis=1)]
-        vx = v0 * np.cos(angle)
-        vy = v0 * np.sin(angle)
+        x0, y0, angle, v0 = x[:,0], x[:,1], x[:,2], x[:,3]
+        vx = _vx(v0, angle)
+        vy = _vy(v0, angle)
         plt.quiver(x0, y0, vx, vy, angles='xy', scale_units='xy',
                    scale=15, width=0.001, headwidth=3, color='red', alpha=0.2,
                    zorder=10, rasterized=True)
@@ -111,27 +229,23 @@ class InverseBallisticsModel():
         plt.gca().set_xticks([]); plt.gca().set_yticks([])
         plt.tight_layout(pad=0, w_pad=-0.5, h_pad=-0.5)
 
-    def find_MAP(self, x):
+    def find_MAP(self, x, n_candidates=2000):
+        # Approximate the MAP by the sample with highest kernel density,
+        # scoring only a random subset of candidates for large samples
+        from scipy.stats import gaussian_kde
         try:
-            mean_shift = MeanShift()
-            mean_shift.fit(x)
-            centers = mean_shift.cluster_centers_
-            kde = KernelDensity(kernel='gaussian', bandwidth=0.1).fit(x)
-
-            best_center = (None, -np.inf)
-            dens = kde.score_samples(centers)
-            for c,d in zip(centers, dens):
-                if d > best_center[1]:
-                    best_center = (c.copy(), d)
-
-            dist_to_best = np.sum((x - best_center[0])**2, axis=1)
-            return np.argmin(dist_to_best)
+            kde = gaussian_kde(x.T)
+            # Own generator, so plotting doesn't advance the prior's random stream
+            idx = np.random.default_rng(0).choice(len(x), min(n_candidates, len(x)), replace=False)
+            return idx[np.argmax(kde(x[idx].T))]
         except:
-            print('Mean shift failed')
+            print('Density estimation failed')
             return 0
 
     def arcarrow(self, start, direction, dist=2, open_angle=45,
                  kw=dict(arrowstyle='<->, head_width=2, head_length=2', ec='black', lw=1)):
+        from matplotlib import pyplot as plt
+        import matplotlib.patches as patches
         angle = np.arctan2(direction[1], direction[0])
         angle1 = angle - np.radians(open_angle/2)
         x1 = start[0] + dist * np.cos(angle1)
@@ -143,6 +257,10 @@ class InverseBallisticsModel():
         plt.text(x1+0.6, y1, r'$x_3$', ha='center', va='center')
 
     def plot_sample(self, x, xs=None, ys=None, colors={}, alphas={}, annotate=False, y_target=None, xlim=[-2, 18], ylim=[-1.5, 6.5]):
+        from matplotlib import pyplot as plt
+        from matplotlib.collections import LineCollection
+        _setup_style()
+
         c = {'lines': (.5,.5,.5), 'arrows': (.2,.2,.2), 'impact': '#96BF0D'}
         c.update(colors)
         colors = c
@@ -154,25 +272,24 @@ class InverseBallisticsModel():
             xs, ys = self.trajectories_from_parameters(x)
         exemplar = self.find_MAP(x)
 
-        # Trajectories
-        lines = np.stack([xs, ys], axis=-1)
-        lines = [np.squeeze(line) for line in np.split(lines, len(lines))]
+        # Trajectories, passed to LineCollection as one (N,T,2) array
+        lines = self.trajectory_lines(xs, ys)
         line_collection = LineCollection(lines, colors=colors['lines'], linewidths=1, alpha=alphas['lines'], zorder=1, rasterized=True)
         plt.gca().add_collection(line_collection)
         # Exemplar trajectory
         plt.plot(xs[exemplar], ys[exemplar], color=(0,0,0), linewidth=1, linestyle='dashed', zorder=100)
 
         # Arrows for initial velocity
-        x0, y0, angle, v0 = [np.squeeze(p) for p in np.split(x[:150], 4, axis=1)]
-        vx = v0 * np.cos(angle)
-        vy = v0 * np.sin(angle)
+        x0, y0, angle, v0 = x[:150,0], x[:150,1], x[:150,2], x[:150,3]
+        vx = _vx(v0, angle)
+        vy = _vy(v0, angle)
         plt.quiver(x0, y0, vx, vy, angles='xy', scale_units='xy',
                    scale=15, width=0.001, headwidth=7, color=colors['arrows'], alpha=alphas['arrows'],
                    zorder=10, rasterized=True)
         # Exemplar arrow
         x0, y0, angle, v0 = x[exemplar]
-        vx = v0 * np.cos(angle)
-        vy = v0 * np.sin(angle)
+        vx = _vx(v0, angle)
+        vy = _vy(v0, angle)
         plt.arrow(x0, y0, vx/5, vy/5,
                   width=0.003, head_width=0.15, color=(0,0,0),
                   zorder=101)
@@ -183,8 +300,8 @@ class InverseBallisticsModel():
             plt.text(-0.4, 0.8, r'$(x_1, x_2)$', ha='center', va='center')
 
         # Impact points
-        xs_impact = self.impact_from_trajectories(xs, ys)
-        exemplar_impact = self.impact_from_trajectories(xs[exemplar:exemplar+1], ys[exemplar:exemplar+1])
+        xs_impact, impact_rows = self.impact_from_trajectories(xs, ys, return_rows=True)
+        exemplar_impact = xs_impact[impact_rows == exemplar]
         if len(xs_impact) > 0:
             plt.scatter(xs_impact, np.zeros(xs_impact.shape),
                         s=5, edgecolor=colors['impact'], facecolor='white', alpha=alphas['impact'],
@@ -195,12 +312,8 @@ class InverseBallisticsModel():
                 if annotate:
                     plt.text(exemplar_impact-0.4, -0.7, r'$y$', ha='center', va='center')
             # Density
-            from scipy.stats import gaussian_kde
-            density = gaussian_kde(xs_impact)
-            density.covariance_factor = lambda: .15
-            density._compute_covariance()
             domain = np.linspace(np.amin(xs_impact)-.5, np.amax(xs_impact)+.5, 200)
-            density = density(domain)
+            density = _fft_kde(xs_impact, domain, bw=.15*np.std(xs_impact))
             plt.fill_between(domain, 3*density/np.amax(density), color=colors['impact'], alpha=alphas['density'])
 
         # X axis
@@ -226,42 +339,44 @@ class InverseBallisticsDataset(Dataset):
         if len(suffix) > 0 and not '_' in suffix[:1]:
             suffix = '_' + suffix
 
+        # Samples and labels are stored row-interleaved in a single file, so
+        # a batch is one contiguous read per row. The file is memory-mapped
+        # (copy-on-write, so torch can wrap it) and only the first n rows
+        # are ever paged in.
+        path = f'{root_dir}/{self.model.name}{suffix}'
         try:
-            x = np.load(f'{root_dir}/{self.model.name}_x{suffix}.npy')[:n,...]
+            xy = np.load(f'{path}.npy', mmap_mode='c')
+            if len(xy) < n:
+                raise ValueError(f'only {len(xy)} samples stored')
+            xy = xy[:n,...]
         except Exception as e:
             print(f'InverseBallisticsDataset: Not enough data for model "{self.model.name}" found, generating {n} new samples...')
-            x = model.sample_prior(n)
-            if root_dir is not None:
-                os.makedirs(root_dir, exist_ok=True)
-                np.save(f'{root_dir}/{self.model.name}_x{suffix}', x)
-        self.x = x
-        try:
-            y = np.load(f'{root_dir}/{self.model.name}_y{suffix}.npy')[:n,...]
-        except Exception as e:
-            print(f'InverseBallisticsDataset: Not enough labels for model "{self.model.name}" found, running forward process on {n} samples...')
-            y = []
-            if n > 100000:
-                for i in range((n-1)//100000 + 1):
-                    print(f'InverseBallisticsDataset: Forward process chunk {i+1}...')
-                    y.append(model.forward_process(x[100000*i : min(n, 100000*(i+1)),...]))
-                y = np.concatenate(y, axis=0)
-            else:
-                y = model.forward_process(x)
+            # Filled in place, so the row-interleaved layout costs no extra copy;
+            # the forward process returns one impact per sample and only keeps
+            # that in memory, so no chunking is needed even for very large n
+            xy = np.empty((n, model.n_parameters + model.n_observations), dtype=np.float32)
+            xy[:,:model.n_parameters] = model.sample_prior(n)
+            xy[:,model.n_parameters:] = model.forward_process(xy[:,:model.n_parameters])
             print()
             if root_dir is not None:
-                np.save(f'{root_dir}/{self.model.name}_y{suffix}', y)
-        self.y = y
+                os.makedirs(root_dir, exist_ok=True)
+                np.save(f'{path}.tmp.npy', xy)
+                os.replace(f'{path}.tmp.npy', f'{path}.npy')
+        xy = torch.from_numpy(np.ascontiguousarray(xy, dtype=np.float32))
+        self.x = xy[:,:model.n_parameters]
+        self.y = xy[:,model.n_parameters:]
 
     def __len__(self):
         return self.n
 
     def __getitem__(self, i):
-        if torch.is_tensor(i):
-            i = i.item()
         return self.x[i], self.y[i]
 
     def get_dataloader(self, batch_size):
-        return DataLoader(self, batch_size=batch_size, shuffle=True, drop_last=True)
+        # Sample whole batches of indices so each batch is a single indexing
+        # operation on the tensors instead of batch_size calls to __getitem__
+        sampler = BatchSampler(RandomSampler(self), batch_size=batch_size, drop_last=True)
+        return DataLoader(self, sampler=sampler, batch_size=None)
 
 
 
@@ -269,12 +384,14 @@ class InverseBallisticsDataset(Dataset):
 if __name__ == '__main__':
     pass
 
-    model = InverseBallisticsModel()
+    from matplotlib import pyplot as plt
+    _setup_style()
+
+    model = InverseBallisticsModel(seed=0)
     # train_data = InverseBallisticsDataset(model, 10000, 'bal_data', suffix='train')
     # train_loader = train_data.get_dataloader(1000)
 
     plt.figure(figsize=(10,4))
-    np.random.seed(0)
     model.plot_sample(model.sample_prior(2000), annotate=True, y_target=0)
     plt.gcf().tight_layout()
     plt.show()